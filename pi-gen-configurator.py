@@ -3,17 +3,25 @@
 import os
 import sys
 import logging
-import fileinput
+import logging.handlers
+import queue
+import atexit
 import shutil
 import getpass
 import subprocess
 import argparse
+import threading
 
-from io import BytesIO
-from zipfile import ZipFile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import closing, contextmanager
+
+from pathlib import Path
+from zipfile import ZipFile, is_zipfile
+import docker
 import requests
 
 from git import Repo
+from git.exc import GitCommandError, InvalidGitRepositoryError
 
 
 class ConfiguratorError(Exception):
@@ -46,13 +54,25 @@ stderr_hdlr.setLevel(logging.WARNING)
 file_hdlr = logging.FileHandler('build.log')
 file_hdlr.setFormatter(formatter)
 
+# Format and write records on a background thread, logging threads only enqueue them
+log_queue = queue.Queue(-1)
+queue_hdlr = logging.handlers.QueueHandler(log_queue)
+
+log_listener = logging.handlers.QueueListener(log_queue, stdout_hdlr, stderr_hdlr, file_hdlr,
+        respect_handler_level=True)
+log_listener.start()
+atexit.register(log_listener.stop)
+
 log = logging.getLogger()
-log.addHandler(stdout_hdlr)
-log.addHandler(stderr_hdlr)
-log.addHandler(file_hdlr) 
+log.addHandler(queue_hdlr)
 
 log.setLevel(logging.DEBUG)
 
+# Persistent object store reused across runs, pi-gen is checked out from it as a worktree
+cache_dir = os.path.join(os.path.expanduser('~'), '.cache', 'pi-gen-configurator')
+pi_gen_cache_dir = os.path.join(cache_dir, 'pi-gen.git')
+pi_gen_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'pi-gen', '')
+
 
 def main():
     sys.excepthook = handle_exception
@@ -73,27 +93,40 @@ def main():
     parser.add_argument('-y', '--layout', action='store', type=str, help='keyboard layout (English (US), English (UK), etc.)')
     args = parser.parse_args()
 
-    _remove_leftovers()
-
-    _clone_pi_gen()
-
-    _change_user_and_password(username=args.username, password=args.password)
-
-    _set_wifi_settings(country_code=args.country_code, ssid=args.ssid, passphrase=args.passphrase)
-
-    _enable_ssh()
-
-    _install_ngrok(skip_ngrok=args.skip_ngrok, authtoken=args.authtoken)
-
-    _change_locale(locale=args.locale)
-
-    _change_timezone(timezone=args.timezone)
-
-    _change_keyborad_layout(keymap=args.keymap, layout=args.layout)
+    # Clone in background while the user answers the prompts
+    executor = ThreadPoolExecutor(max_workers=1)
+    clone = executor.submit(_clone_pi_gen)
+    try:
+        with _hold_log_output():
+            _collect_inputs(args)
+
+        _remove_leftovers()
+
+        clone.result()
+    except BaseException:
+        # Don't keep Ctrl-C or an error waiting for the fetch to finish
+        executor.shutdown(wait=False, cancel_futures=True)
+        raise
+    executor.shutdown()
+
+    # Steps below touch disjoint files under pi-gen, so they can run concurrently
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        futures = [
+            executor.submit(_change_user_and_password, username=args.username, password=args.password),
+            executor.submit(_set_wifi_settings, country_code=args.country_code, ssid=args.ssid,
+                    passphrase=args.passphrase),
+            executor.submit(_enable_ssh),
+            executor.submit(_install_ngrok, skip_ngrok=args.skip_ngrok, authtoken=args.authtoken),
+            executor.submit(_change_locale, locale=args.locale),
+            executor.submit(_change_timezone, timezone=args.timezone),
+            executor.submit(_change_keyborad_layout, keymap=args.keymap, layout=args.layout),
+        ]
+        for future in as_completed(futures):
+            future.result()
 
     _build_image(hostname=args.hostname)
 
-    _copy_artifacts()
+    _move_artifacts()
 
     _clean_up()
 
@@ -113,95 +146,176 @@ def _remove_leftovers():
 
     # TODO not removing if running
     container_name = 'pigen_work'
-    with subprocess.Popen(f'[ $(docker ps -a -q -f name={container_name}) ] && docker rm -v {container_name} || true',
-            shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, bufsize=1,
-            universal_newlines=True) as proc:
-        exit_code = proc.wait()
-        if exit_code != 0:
-            stderr = ", ".join(map(lambda s: s.rstrip(), proc.stderr.readlines()))
-            log.error(f"failed to remove previous docker container with error code {exit_code} " \
-                f"and stderr: {stderr}")
-            raise ConfiguratorError(f'Cannot build image')
-
+    try:
+        with closing(docker.from_env()) as client:
+            client.containers.get(container_name).remove(v=True, force=False)
+    except docker.errors.NotFound:
+        pass
+    except docker.errors.DockerException as e:
+        log.error(f"failed to remove previous docker container with error: {e}")
+        raise ConfiguratorError(f'Cannot build image, make sure docker daemon is running and accessible')
+
+
+@contextmanager
+def _hold_log_output():
+    """Keep log records queued, so messages from background threads don't interleave with prompts"""
+    log_listener.stop()
+    try:
+        yield
+    finally:
+        log_listener.start()
+
+
+def _collect_inputs(args):
+    """Ask for all missing parameters up front, so configuration steps don't need stdin"""
+    if not args.username:
+        args.username = input("What is your username: ")
+    if not args.password:
+        while True:
+            args.password = getpass.getpass("What is your password: ")
+            retype = getpass.getpass("Retype your password again: ")
+            if args.password == retype:
+                break
+            print('Passwords do not match, please try again')
 
-def _clone_pi_gen():
-    # Clone specific commit to avoid possible issues
-    repo_str = 'git@github.com:RPi-Distro/pi-gen.git'
-    sha1 = '5436273ec728c8369dab9c08f2739805f20510f7'
+    if not args.country_code:
+        args.country_code = input("What is your country alpha-2 code (can be found at https://en.wikipedia.org/wiki/ISO_3166-1): ")
+        while not args.country_code or len(args.country_code) != 2:
+            args.country_code = input("Please re-type your country code: ")
+    if not args.ssid:
+        args.ssid = input("What is your wifi SSID: ")
+    if not args.passphrase:
+        while True:
+            args.passphrase = getpass.getpass("Please enter WiFi's passphrase: ")
+            retype = getpass.getpass("Retype WiFi's passphrase again: ")
+            if args.passphrase == retype:
+                break
+            print('Passphrases do not match, please try again')
 
-    repo_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'pi-gen', '')
+    if not args.skip_ngrok and not args.authtoken:
+        if query_yes_no('do you want to set up ngrok', 'no'):
+            args.authtoken = input("What is your ngrok authtoken: ")
+        else:
+            args.skip_ngrok = True
 
-    if os.path.exists(repo_dir):
-        shutil.rmtree(repo_dir)
+    if not args.locale:
+        args.locale = input("What locale to use (e.g. en_US.UTF-8): ")
 
-    log.info(f'cloning {repo_str} to {repo_dir}')
-    repo = Repo.clone_from(repo_str, repo_dir)
+    if not args.timezone:
+        args.timezone = input("What is your timezone (e.g. America/New_York)"
+            "(can be found at https://en.wikipedia.org/wiki/List_of_tz_database_time_zones): ")
 
-    log.info(f'checking out {sha1}')
-    repo.head.reset(commit=sha1)
+    # TODO dynamically fetch all of the below
+    # TODO should be from /usr/share/X11/xkb/symbols
+    if not args.keymap:
+        args.keymap = input("What is your keymap (gb, us, etc.): ")
+    if not args.layout:
+        args.layout = input("What is your keyboard layout (English (US), English (UK), etc.): ")
 
 
-def _change_user_and_password(username=None, password=None):
-    if not username:
-        username = input("What is your username: ")
-    if not password:
-        while True:
-            password = getpass.getpass("What is your password: ")
-            retype = getpass.getpass("Retype your password again: ")
-            if password == retype:
-                break
-            print('Passwords do not match, please try again')
+def _clone_pi_gen():
+    # Clone specific commit to avoid possible issues
+    repo_str = 'git@github.com:RPi-Distro/pi-gen.git'
+    sha1 = '5436273ec728c8369dab9c08f2739805f20510f7'
 
+    if os.path.exists(pi_gen_cache_dir):
+        cache = Repo(pi_gen_cache_dir)
+    else:
+        log.info(f'creating pi-gen cache at {pi_gen_cache_dir}')
+        cache = Repo.init(pi_gen_cache_dir, mkdir=True, bare=True)
+        cache.create_remote('origin', repo_str)
+
+    if os.path.exists(pi_gen_dir):
+        if _is_pristine_checkout(pi_gen_dir, sha1):
+            log.info(f'{pi_gen_dir} is already checked out at {sha1}')
+            return
+        shutil.rmtree(pi_gen_dir)
+    cache.git.worktree('prune')
+
+    if _has_commit(cache, sha1):
+        log.info(f'{sha1} found in cache')
+    else:
+        log.info(f'fetching {sha1} from {repo_str} to {pi_gen_cache_dir}')
+        # Fetch runs while the user answers prompts, so ssh and git must not ask for anything themselves
+        ssh_command = os.environ.get('GIT_SSH_COMMAND', 'ssh')
+        with cache.git.custom_environment(GIT_SSH_COMMAND=f'{ssh_command} -o BatchMode=yes',
+                GIT_TERMINAL_PROMPT='0'):
+            try:
+                _fetch_commit(cache, repo_str, sha1)
+            except GitCommandError as e:
+                log.error(f'failed to fetch {repo_str} with error: {e.stderr.strip()}')
+                raise ConfiguratorError(f'Cannot fetch pi-gen, make sure that ssh can connect to github.com '
+                        'without prompting (host key in known_hosts, key loaded into ssh-agent)')
+
+    log.info(f'checking out {sha1} to {pi_gen_dir}')
+    cache.git.worktree('add', '--detach', pi_gen_dir, sha1)
+
+
+def _fetch_commit(repo, repo_str, sha1):
+    # History is not needed, so fetch only the pinned commit and keep it referenced in the cache
+    # Call git fetch directly, GitPython cannot parse FETCH_HEAD written for a fetch by SHA
+    try:
+        repo.git.fetch('origin', f'{sha1}:refs/pinned/{sha1}', depth=1)
+    except GitCommandError:
+        # Server does not allow fetching unadvertised commits, deepen master history until it is reached
+        log.info(f'cannot fetch {sha1} directly, fetching master history instead')
+        repo.git.fetch('origin', 'master', depth=1)
+        while not _has_commit(repo, sha1):
+            if not os.path.exists(os.path.join(repo.git_dir, 'shallow')):
+                raise ConfiguratorError(f'{sha1} is not reachable from master of {repo_str}')
+            repo.git.fetch('origin', 'master', deepen=100)
+        repo.git.update_ref(f'refs/pinned/{sha1}', sha1)
+
+
+def _has_commit(repo, sha1):
+    try:
+        repo.git.cat_file('-e', f'{sha1}^{{commit}}')
+        return True
+    except GitCommandError:
+        return False
+
+
+def _is_pristine_checkout(repo_dir, sha1):
+    """Check if repo_dir is an unmodified worktree of pi-gen cache at sha1"""
+    try:
+        repo = Repo(repo_dir)
+    except InvalidGitRepositoryError:
+        return False
+
+    return os.path.realpath(repo.common_dir) == os.path.realpath(pi_gen_cache_dir) \
+        and repo.head.commit.hexsha == sha1 \
+        and not repo.is_dirty(untracked_files=True)
+
+
+def _change_user_and_password(username, password):
     files_dir = 'pi-gen/stage2/03-username-password/'
-    if not os.path.exists(files_dir):
-        os.makedirs(files_dir)
+    os.makedirs(files_dir, exist_ok=True)
 
     run_file = os.path.join(files_dir, '00-run.sh')
-    with open(run_file, "w") as f:
-        f.write('#!/bin/bash -e'
-                '\n'
-                'on_chroot << EOF\n'
-                f'usermod -l {username} pi\n'
-                f'usermod -m -d /home/{username} {username}\n'
-                f'echo -e "{password}\n{password}" | passwd {username}\n'
-                'EOF\n')
+    Path(run_file).write_text('#!/bin/bash -e'
+            '\n'
+            'on_chroot << EOF\n'
+            f'usermod -l {username} pi\n'
+            f'usermod -m -d /home/{username} {username}\n'
+            f'echo -e "{password}\n{password}" | passwd {username}\n'
+            'EOF\n')
 
     os.chmod(run_file, 0o755)
 
 
-def _set_wifi_settings(country_code=None, ssid=None, passphrase=None):
-    if not country_code:
-        country_code = input("What is your country alpha-2 code (can be found at https://en.wikipedia.org/wiki/ISO_3166-1): ")
-        while not country_code or len(country_code) is not 2:
-            country_code = input("Please re-type your country code: ")
-    
-    if not ssid:
-        ssid = input("What is your wifi SSID: ")
-    if not passphrase:
-        while True:
-            passphrase = getpass.getpass("Please enter WiFi's passphrase: ")
-            retype = getpass.getpass("Retype WiFi's passphrase again: ")
-            if passphrase == retype:
-                break
-            print('Passphrases do not match, please try again')
-
-    filename = 'pi-gen/stage2/02-net-tweaks/files/wpa_supplicant.conf'
-    with fileinput.input(filename, inplace=True) as f:
-        for line in f:
-            if fileinput.isfirstline():
-                print(f'country={country_code}')
-
-            print(line, end='')
+def _set_wifi_settings(country_code, ssid, passphrase):
+    conf_file = Path('pi-gen/stage2/02-net-tweaks/files/wpa_supplicant.conf')
+    lines = conf_file.read_text().splitlines(keepends=True)
+    conf_file.write_text(''.join([f'country={country_code}\n'] + lines))
 
     run_file = 'pi-gen/stage2/02-net-tweaks/02-run.sh'
-    with open(run_file, "w") as f:
-        f.write('#!/bin/bash -e'
-                '\n'
-                'echo "adding wifi network to /etc/wpa_supplicant/wpa_supplicant.conf"\n'
-                'on_chroot << EOF\n'
-                '  echo "" >> /etc/wpa_supplicant/wpa_supplicant.conf\n'
-                f'  wpa_passphrase \"{ssid}\" \"{passphrase}\" | sed \'/^[ \\t]*#/ d\' >> /etc/wpa_supplicant/wpa_supplicant.conf\n'
-                'EOF\n')
+    Path(run_file).write_text('#!/bin/bash -e'
+            '\n'
+            'echo "adding wifi network to /etc/wpa_supplicant/wpa_supplicant.conf"\n'
+            'on_chroot << EOF\n'
+            '  echo "" >> /etc/wpa_supplicant/wpa_supplicant.conf\n'
+            f'  wpa_passphrase \"{ssid}\" \"{passphrase}\" | sed \'/^[ \\t]*#/ d\' >> /etc/wpa_supplicant/wpa_supplicant.conf\n'
+            'EOF\n')
 
     os.chmod(run_file, 0o755)
 
@@ -211,32 +325,22 @@ def _enable_ssh():
     filename = '00-run.sh'
     full_path = os.path.join(dirname, filename)
 
-    if not os.path.exists(dirname):
-        os.makedirs(dirname)
+    os.makedirs(dirname, exist_ok=True)
 
-    with open(full_path, "w") as f:
-        f.write('#!/bin/bash -e\n\n# Enable SSH daemon by default.\ntouch "$ROOTFS_DIR"/boot/ssh')
+    Path(full_path).write_text('#!/bin/bash -e\n\n# Enable SSH daemon by default.\ntouch "$ROOTFS_DIR"/boot/ssh')
 
     os.chmod(full_path, 0o755)
 
 
-def _install_ngrok(skip_ngrok=False, authtoken=None):
+def _install_ngrok(skip_ngrok, authtoken):
     if skip_ngrok:
         return
 
-    if authtoken:
-        yes_no = 'yes'
-    else:
-        yes_no = query_yes_no('do you want to set up ngrok', 'no')
-    if not yes_no:
-        return
-
     target_dir = 'pi-gen/stage2/04-custom-installations/'
     files_dirname = 'files'
     files_dir = os.path.join(target_dir, files_dirname, '')
 
-    if not os.path.exists(files_dir):
-        os.makedirs(files_dir)
+    os.makedirs(files_dir, exist_ok=True)
 
     _download_ngrok(files_dir)
 
@@ -247,147 +351,171 @@ def _install_ngrok(skip_ngrok=False, authtoken=None):
     _add_ngrok_cronjob(files_dir, start_script_file)
 
     run_file = os.path.join(target_dir, '00-run.sh')
-    with open(run_file, "w") as f:
-        f.write('#!/bin/bash -e\n\n'
-                '# Copy ngrok to /usr/local/bin.\n'
-                'install -d "${ROOTFS_DIR}/usr/local/bin"\n'
-                f'install -m 755 {files_dirname}/ngrok "${{ROOTFS_DIR}}/usr/local/bin/"\n\n'
-                '# Copy ngrok config to /etc/opt/scripts/ngrok\n'
-                'install -d "${ROOTFS_DIR}/etc/opt/scripts/ngrok"\n'
-                f'install -m 644 {files_dirname}/{config_file} "${{ROOTFS_DIR}}/etc/opt/scripts/ngrok/"\n\n'
-                '# Copy ngrok start script to /etc/cron.hourly/\n'
-                'install -d "${ROOTFS_DIR}/etc/cron.hourly/"\n'
-                f'install -m 755 {files_dirname}/{start_script_file} "${{ROOTFS_DIR}}/etc/cron.hourly/"\n')
+    Path(run_file).write_text('#!/bin/bash -e\n\n'
+            '# Copy ngrok to /usr/local/bin.\n'
+            'install -d "${ROOTFS_DIR}/usr/local/bin"\n'
+            f'install -m 755 {files_dirname}/ngrok "${{ROOTFS_DIR}}/usr/local/bin/"\n\n'
+            '# Copy ngrok config to /etc/opt/scripts/ngrok\n'
+            'install -d "${ROOTFS_DIR}/etc/opt/scripts/ngrok"\n'
+            f'install -m 644 {files_dirname}/{config_file} "${{ROOTFS_DIR}}/etc/opt/scripts/ngrok/"\n\n'
+            '# Copy ngrok start script to /etc/cron.hourly/\n'
+            'install -d "${ROOTFS_DIR}/etc/cron.hourly/"\n'
+            f'install -m 755 {files_dirname}/{start_script_file} "${{ROOTFS_DIR}}/etc/cron.hourly/"\n')
 
     os.chmod(run_file, 0o755)
 
 
 def _download_ngrok(files_dir):
-    r = requests.get('https://bin.equinox.io/c/4VmDzA7iaHb/ngrok-stable-linux-arm.zip')
-    z = ZipFile(BytesIO(r.content))
-    z.extractall(files_dir)
+    url = 'https://bin.equinox.io/c/4VmDzA7iaHb/ngrok-stable-linux-arm.zip'
+    zip_file = os.path.join(cache_dir, 'ngrok-stable-linux-arm.zip')
+    etag_file = Path(f'{zip_file}.etag')
+
+    # Download archive only if it changed since it was cached
+    headers = {}
+    if is_zipfile(zip_file) and etag_file.exists():
+        headers['If-None-Match'] = etag_file.read_text()
+
+    with requests.get(url, headers=headers, stream=True) as r:
+        r.raise_for_status()
+        if r.status_code == requests.codes.not_modified:
+            log.info(f'using cached {zip_file}')
+        else:
+            log.info(f'downloading {url} to {zip_file}')
+            os.makedirs(cache_dir, exist_ok=True)
+            part_file = f'{zip_file}.part'
+            # Raw stream is not decoded by requests, so ask for Content-Encoding to be undone
+            r.raw.decode_content = True
+            with open(part_file, 'wb') as f:
+                shutil.copyfileobj(r.raw, f, length=1024 * 1024)
+            os.replace(part_file, zip_file)
+
+            etag = r.headers.get('ETag')
+            if etag:
+                etag_file.write_text(etag)
+            elif etag_file.exists():
+                etag_file.unlink()
+
+    with ZipFile(zip_file) as z:
+        z.extractall(files_dir)
 
     for filename in os.listdir(files_dir):
         if not filename == 'ngrok':
             raise ConfiguratorError(f'should be ngrok file in archive, but was {filename}')
 
 
-def _create_ngrok_config(files_dir, config_filename, authtoken=None):
-    if not authtoken:
-        authtoken = input("What is your ngrok authtoken: ")
-
-    with open(os.path.join(files_dir, config_filename), "w") as f:
-        f.write(f'authtoken: {authtoken}\n'
-                'tunnels:\n'
-                '  ssh:\n'
-                '    proto: tcp\n'
-                '    addr: 22\n')
+def _create_ngrok_config(files_dir, config_filename, authtoken):
+    Path(os.path.join(files_dir, config_filename)).write_text(f'authtoken: {authtoken}\n'
+            'tunnels:\n'
+            '  ssh:\n'
+            '    proto: tcp\n'
+            '    addr: 22\n')
 
 
 def _add_ngrok_cronjob(files_dir, filename):
-    with open(os.path.join(files_dir, filename), "w") as f:
-        f.write('#!/bin/bash -e\n'
-                '\n'
-                '# This script checks if ngrok is not running and starts a tunnel if not.\n'
-                '\n'
-                'if ps -ax | grep ngrok | grep -q ssh ; then\n'
-                '  echo "$HOSTNAME SSH tunnel is already created"\n'
-                'else\n'
-                '  echo "$HOSTNAME SSH tunnel is down, setting it up now" >&2\n'
-                '  /usr/local/bin/ngrok start -config "/etc/opt/scripts/ngrok/ssh_config.yml" ssh > /dev/null &\n'
-                '\n'
-                '  status=$?\n'
-                '  if [ $status -eq 0 ]; then\n'
-                '    echo "tunnel should be started"\n'
-                '  else\n'
-                '    echo "cannot start tunnel" >&2\n'
-                '  fi\n'
-                'fi\n')
+    Path(os.path.join(files_dir, filename)).write_text('#!/bin/bash -e\n'
+            '\n'
+            '# This script checks if ngrok is not running and starts a tunnel if not.\n'
+            '\n'
+            'if ps -ax | grep ngrok | grep -q ssh ; then\n'
+            '  echo "$HOSTNAME SSH tunnel is already created"\n'
+            'else\n'
+            '  echo "$HOSTNAME SSH tunnel is down, setting it up now" >&2\n'
+            '  /usr/local/bin/ngrok start -config "/etc/opt/scripts/ngrok/ssh_config.yml" ssh > /dev/null &\n'
+            '\n'
+            '  status=$?\n'
+            '  if [ $status -eq 0 ]; then\n'
+            '    echo "tunnel should be started"\n'
+            '  else\n'
+            '    echo "cannot start tunnel" >&2\n'
+            '  fi\n'
+            'fi\n')
 
 
 def _change_locale(locale):
-    if not locale:
-        locale = input("What locale to use (e.g. en_US.UTF-8): ")
-
-    with fileinput.input('pi-gen/stage0/01-locale/00-debconf', inplace=True) as file:
-        for line in file:
-            print(line.replace("select\ten_GB.UTF-8", f"select\t{locale}"), end='')
+    debconf_file = Path('pi-gen/stage0/01-locale/00-debconf')
+    data = debconf_file.read_text()
+    debconf_file.write_text(data.replace("select\ten_GB.UTF-8", f"select\t{locale}"))
 
 
-def _change_timezone(timezone=None):
-    if not timezone:
-        timezone = input("What is your timezone (e.g. America/New_York)"
-            "(can be found at https://en.wikipedia.org/wiki/List_of_tz_database_time_zones): ")
-
+def _change_timezone(timezone):
     run_dir = 'pi-gen/stage2/05-timezone'
 
-    if not os.path.exists(run_dir):
-        os.makedirs(run_dir)
+    os.makedirs(run_dir, exist_ok=True)
 
     run_file = os.path.join(run_dir, '00-run.sh')
-    with open(run_file, "w") as f:
-        f.write('#!/bin/bash -e'
-                '\n'
-                f'echo "changing timezone to: {timezone}"\n'
-                'on_chroot << EOF\n'
-                '  unlink /etc/localtime\n'
-                f'  echo \'{timezone}\' > /etc/timezone\n'
-                '  dpkg-reconfigure tzdata\n'
-                'EOF\n')
+    Path(run_file).write_text('#!/bin/bash -e'
+            '\n'
+            f'echo "changing timezone to: {timezone}"\n'
+            'on_chroot << EOF\n'
+            '  unlink /etc/localtime\n'
+            f'  echo \'{timezone}\' > /etc/timezone\n'
+            '  dpkg-reconfigure tzdata\n'
+            'EOF\n')
 
     os.chmod(run_file, 0o755)
 
 
-def _change_keyborad_layout(keymap=None, layout=None):
-    # TODO dynamically fetch all of the below
-    # TODO should be from /usr/share/X11/xkb/symbols
-    if not keymap:
-        keymap = input("What is your keymap (gb, us, etc.): ")
-    if not layout:
-        layout = input("What is your keyboard layout (English (US), English (UK), etc.): ")
-
-    with fileinput.input('pi-gen/stage2/01-sys-tweaks/00-debconf', inplace=True) as file:
-        for line in file:
-            print(line.replace("keyboard-configuration	keyboard-configuration/xkb-keymap	select	gb", f"keyboard-configuration	keyboard-configuration/xkb-keymap	select	{keymap}")
-                .replace("keyboard-configuration  keyboard-configuration/variant  select  English (UK)", f"keyboard-configuration  keyboard-configuration/variant  select  {layout}"), end='')
+def _change_keyborad_layout(keymap, layout):
+    debconf_file = Path('pi-gen/stage2/01-sys-tweaks/00-debconf')
+    data = debconf_file.read_text()
+    debconf_file.write_text(data.replace("keyboard-configuration	keyboard-configuration/xkb-keymap	select	gb", f"keyboard-configuration	keyboard-configuration/xkb-keymap	select	{keymap}")
+        .replace("keyboard-configuration  keyboard-configuration/variant  select  English (UK)", f"keyboard-configuration  keyboard-configuration/variant  select  {layout}"))
 
 
 def _build_image(hostname):
     """Build image using docker method"""
-    with open('pi-gen/config', "w") as f:
-        f.write(f'IMG_NAME={hostname}\n')
-        f.write(f'HOSTNAME={hostname}\n')
+    Path('pi-gen/config').write_text(f'IMG_NAME={hostname}\n'
+            f'HOSTNAME={hostname}\n')
 
-    [touch(it) for it in ['pi-gen/stage3/SKIP', 'pi-gen/stage4/SKIP', 'pi-gen/stage5/SKIP']]
-    [touch(it) for it in ['pi-gen/stage4/SKIP_IMAGES', 'pi-gen/stage5/SKIP_IMAGES']]
+    for path in ['pi-gen/stage3/SKIP', 'pi-gen/stage4/SKIP', 'pi-gen/stage5/SKIP',
+            'pi-gen/stage4/SKIP_IMAGES', 'pi-gen/stage5/SKIP_IMAGES']:
+        _touch_empty(path)
 
     log.debug('starting image building')
+    # Write build output to build.log without going through logging handlers, it is mirrored to stdout
+    # only when debug messages go there. Pending log records are written first so they don't interleave with it
+    mirror_output = log.isEnabledFor(logging.DEBUG) and stdout_hdlr.level <= logging.DEBUG
+    log_queue.join()
+    sys.stdout.flush()
     with subprocess.Popen('./build-docker.sh', cwd='pi-gen', shell=True,
-            stdout=subprocess.PIPE, stderr=subprocess.PIPE, bufsize=1,
-            universal_newlines=True) as proc:
-        for line in proc.stdout:
-            log.debug(line.rstrip())
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE) as proc, \
+            open('build.log', 'ab', buffering=0) as build_file:
+        # Drain stderr separately, otherwise the build blocks once stderr pipe is full
+        stderr_lines = []
+        stderr_reader = threading.Thread(target=lambda: stderr_lines.extend(proc.stderr.readlines()))
+        stderr_reader.start()
+
+        while True:
+            chunk = os.read(proc.stdout.fileno(), 64 * 1024)
+            if not chunk:
+                break
 
+            build_file.write(chunk)
+            if mirror_output:
+                sys.stdout.buffer.write(chunk)
+                sys.stdout.buffer.flush()
+
+        stderr_reader.join()
         exit_code = proc.wait()
         if exit_code != 0:
-            stderr = ", ".join(map(lambda s: s.rstrip(), proc.stderr.readlines()))
+            stderr = ", ".join(map(lambda s: s.decode(errors='replace').rstrip(), stderr_lines))
             log.error(f"image building failed with error code {exit_code} " \
                 f"and stderr: {stderr}")
             raise ConfiguratorError(f'Cannot build image, check logs for details')
 
 
-def touch(path):
-    with open(path, 'a'):
-        os.utime(path, None)
+def _touch_empty(path):
+    # Only existence of the file matters, so there is no need to update its times
+    os.close(os.open(path, os.O_WRONLY | os.O_CREAT, 0o644))
 
 
-def _copy_artifacts():
-    shutil.copytree('pi-gen/deploy', './artifacts')
+def _move_artifacts():
+    # pi-gen is removed after the build, so there is no need to copy the images
+    shutil.move('pi-gen/deploy', './artifacts')
 
 
 def _clean_up():
-    pass
-    shutil.rmtree('pi-gen')
+    Repo(pi_gen_cache_dir).git.worktree('remove', '--force', pi_gen_dir)
 
 
 def query_yes_no(question: str, default: str="yes") -> bool:
@@ -0,0 +1,82 @@
+import importlib.util
+import os
+import subprocess
+
+import pytest
+
+from git import Repo
+
+
+@pytest.fixture(scope='module')
+def configurator(tmp_path_factory):
+    # Module sets up a build.log file handler on import, keep it out of the source tree
+    cwd = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp('cwd'))
+    try:
+        path = os.path.join(os.path.dirname(__file__), os.pardir, 'pi-gen-configurator.py')
+        spec = importlib.util.spec_from_file_location('pi_gen_configurator', path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    finally:
+        os.chdir(cwd)
+    return module
+
+
+def _git(*args, cwd):
+    env = dict(os.environ, GIT_AUTHOR_NAME='test', GIT_AUTHOR_EMAIL='test@example.com',
+            GIT_COMMITTER_NAME='test', GIT_COMMITTER_EMAIL='test@example.com')
+    return subprocess.run(['git', *args], cwd=cwd, env=env, check=True,
+            stdout=subprocess.PIPE, universal_newlines=True).stdout.strip()
+
+
+@pytest.fixture
+def remote(tmp_path):
+    remote_dir = tmp_path / 'remote'
+    _git('init', '-q', '-b', 'master', str(remote_dir), cwd=tmp_path)
+    for i in range(5):
+        _git('commit', '-q', '--allow-empty', '-m', f'commit {i}', cwd=remote_dir)
+    return remote_dir
+
+
+def _cache(tmp_path, remote_str):
+    cache = Repo.init(tmp_path / 'cache.git', mkdir=True, bare=True)
+    cache.create_remote('origin', remote_str)
+    return cache
+
+
+def test_fetch_commit_by_sha(configurator, remote, tmp_path):
+    _git('config', 'uploadpack.allowAnySHA1InWant', 'true', cwd=remote)
+    sha1 = _git('rev-parse', 'HEAD~3', cwd=remote)
+    cache = _cache(tmp_path, remote.as_uri())
+
+    configurator._fetch_commit(cache, remote.as_uri(), sha1)
+
+    assert cache.git.rev_parse(f'refs/pinned/{sha1}') == sha1
+
+
+def test_fetch_commit_deepens_master(configurator, remote, tmp_path):
+    _git('config', 'uploadpack.allowAnySHA1InWant', 'false', cwd=remote)
+    _git('config', 'uploadpack.allowReachableSHA1InWant', 'false', cwd=remote)
+    sha1 = _git('rev-parse', 'HEAD~3', cwd=remote)
+    cache = _cache(tmp_path, remote.as_uri())
+    # Protocol v0 refuses unadvertised objects, so fetching by SHA fails
+    cache.git.config('protocol.version', '0')
+
+    configurator._fetch_commit(cache, remote.as_uri(), sha1)
+
+    assert cache.git.rev_parse(f'refs/pinned/{sha1}') == sha1
+
+
+def test_fetch_commit_not_on_master(configurator, remote, tmp_path):
+    _git('config', 'uploadpack.allowAnySHA1InWant', 'false', cwd=remote)
+    _git('config', 'uploadpack.allowReachableSHA1InWant', 'false', cwd=remote)
+    _git('checkout', '-q', '-b', 'other', cwd=remote)
+    _git('commit', '-q', '--allow-empty', '-m', 'other 0', cwd=remote)
+    _git('commit', '-q', '--allow-empty', '-m', 'other 1', cwd=remote)
+    sha1 = _git('rev-parse', 'HEAD~1', cwd=remote)
+    _git('checkout', '-q', 'master', cwd=remote)
+    cache = _cache(tmp_path, remote.as_uri())
+    cache.git.config('protocol.version', '0')
+
+    with pytest.raises(configurator.ConfiguratorError):
+        configurator._fetch_commit(cache, remote.as_uri(), sha1)